@@ -1,13 +1,32 @@
-from flask import Flask, render_template, request, redirect, url_for, session, abort
+from flask import Flask, render_template, request, redirect, url_for, session, abort, g
+from flask_session import Session
 import sqlite3
 import stripe
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 from functools import wraps
+import hashlib
+import secrets
+import time
 import os
 
 app = Flask(__name__)
 app.secret_key = "SUPER_SECRET_KEY"
 
+# Server-side sessions: the cookie only carries the signed session id, and
+# session files live in the app's own instance folder. Stored sessions expire after PERMANENT_SESSION_LIFETIME even when not
+# permanent, and once SESSION_FILE_THRESHOLD files exist the store starts
+# deleting live sessions, so keep the lifetime short and the threshold
+# well above the number of visitors expected within it.
+app.config.update(
+    SESSION_TYPE="filesystem",
+    SESSION_FILE_DIR=os.path.join(app.instance_path, "flask_session"),
+    SESSION_FILE_THRESHOLD=20000,
+    SESSION_PERMANENT=False,
+    SESSION_USE_SIGNER=True,
+    PERMANENT_SESSION_LIFETIME=timedelta(days=1),
+)
+Session(app)
+
 # Stripe test key (change to your key)
 stripe.api_key = "sk_test_1234"
 
@@ -18,15 +37,37 @@ YOUR_DOMAIN = "https://ott7.onrender.com"  # update this
 # =====================================================
 DB_FILE = "ott.db"
 
+# (id, name, price, logo) rows seeded into an empty plans table
+DEFAULT_PLANS = (
+    (1, "Netflix Standard", 199, "netflix.png"),
+    (2, "Amazon Prime Video", 149, "prime.png"),
+    (3, "Disney+ Hotstar Premium", 299, "hotstar.png"),
+    (4, "Sony LIV Premium", 129, "sonyliv.png"),
+    (5, "Zee5 Premium", 99, "zee5.png"),
+)
+
 def get_db():
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
-    return conn
+    # One connection per app context, closed in close_db()
+    db = g.get("_db")
+    if db is None:
+        db = g._db = sqlite3.connect(DB_FILE)
+        db.row_factory = sqlite3.Row
+    return db
+
+@app.teardown_appcontext
+def close_db(exc):
+    db = g.pop("_db", None)
+    if db is not None:
+        db.close()
 
 def init_db():
     conn = get_db()
     cur = conn.cursor()
 
+    # WAL lets gunicorn workers read while another one writes
+    cur.execute("PRAGMA journal_mode=WAL")
+    cur.execute("PRAGMA synchronous=NORMAL")
+
     cur.execute("""
         CREATE TABLE IF NOT EXISTS plans (
             id INTEGER PRIMARY KEY,
@@ -42,10 +83,39 @@ def init_db():
             code TEXT UNIQUE,
             type TEXT,
             amount INTEGER,
-            expires_at TEXT
+            expires_at TEXT,
+            expires_at_ts INTEGER
         )
     """)
 
+    # expires_at_ts mirrors the ISO expires_at as a unix timestamp so the
+    # checkout path only does an integer compare. Older databases predate
+    # the column, and coupons are written outside this app, so add it if
+    # missing, resync existing rows and keep it in sync with triggers.
+    cur.execute("PRAGMA table_info(coupons)")
+    if "expires_at_ts" not in [r["name"] for r in cur.fetchall()]:
+        cur.execute("ALTER TABLE coupons ADD COLUMN expires_at_ts INTEGER")
+    cur.execute("""
+        UPDATE coupons SET expires_at_ts = CAST(strftime('%s', expires_at) AS INTEGER)
+        WHERE expires_at_ts IS NOT CAST(strftime('%s', expires_at) AS INTEGER)
+    """)
+    cur.execute("""
+        CREATE TRIGGER IF NOT EXISTS coupons_expires_at_ts_insert
+        AFTER INSERT ON coupons
+        BEGIN
+            UPDATE coupons SET expires_at_ts = CAST(strftime('%s', NEW.expires_at) AS INTEGER)
+            WHERE id = NEW.id;
+        END
+    """)
+    cur.execute("""
+        CREATE TRIGGER IF NOT EXISTS coupons_expires_at_ts_update
+        AFTER UPDATE OF expires_at ON coupons
+        BEGIN
+            UPDATE coupons SET expires_at_ts = CAST(strftime('%s', NEW.expires_at) AS INTEGER)
+            WHERE id = NEW.id;
+        END
+    """)
+
     cur.execute("""
         CREATE TABLE IF NOT EXISTS admin (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -60,28 +130,33 @@ def init_db():
         cur.execute("INSERT INTO admin (username, password) VALUES ('admin', 'admin123')")
 
     conn.commit()
-    conn.close()
 
 def seed_plans():
     conn = get_db()
     cur = conn.cursor()
 
-    cur.execute("SELECT COUNT(1) as cnt FROM plans")
-    if cur.fetchone()["cnt"] == 0:
-        default = [
-            (1, "Netflix Standard", 199, "netflix.png"),
-            (2, "Amazon Prime Video", 149, "prime.png"),
-            (3, "Disney+ Hotstar Premium", 299, "hotstar.png"),
-            (4, "Sony LIV Premium", 129, "sonyliv.png"),
-            (5, "Zee5 Premium", 99, "zee5.png"),
-        ]
-        cur.executemany("INSERT INTO plans (id, name, price, logo) VALUES (?, ?, ?, ?)", default)
-        conn.commit()
+    cur.execute("SELECT 1 FROM plans LIMIT 1")
+    if cur.fetchone():
+        return
+
+    cur.execute("BEGIN")
+    cur.executemany("INSERT INTO plans (id, name, price, logo) VALUES (?, ?, ?, ?)", DEFAULT_PLANS)
+    conn.commit()
 
-    conn.close()
+# Plans are seeded once and never modified by the app, so keep them in memory
+PLANS_BY_ID = {}
+PLANS_LIST = []
 
-init_db()
-seed_plans()
+def _reload_plans():
+    global PLANS_BY_ID, PLANS_LIST
+    rows = get_db().execute("SELECT * FROM plans ORDER BY id").fetchall()
+    PLANS_BY_ID = {r["id"]: dict(r) for r in rows}
+    PLANS_LIST = list(PLANS_BY_ID.values())
+
+with app.app_context():
+    init_db()
+    seed_plans()
+    _reload_plans()
 
 # =====================================================
 # AUTH HELPERS
@@ -94,49 +169,55 @@ def admin_required(f):
         return f(*args, **kwargs)
     return wrap
 
+def regenerate_session():
+    # Move the session to a fresh id so a session id planted before login
+    # never gains the new privileges
+    iface = app.session_interface
+    iface.cache.delete(iface.key_prefix + session.sid)
+    session.sid = secrets.token_urlsafe(iface.sid_length)
+    session.modified = True
+
 # =====================================================
 # UTILITIES
 # =====================================================
 def query_plans():
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM plans ORDER BY id")
-    rows = cur.fetchall()
-    conn.close()
-    return [dict(r) for r in rows]
+    return PLANS_LIST
 
 def get_plan(plan_id):
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM plans WHERE id=?", (plan_id,))
-    row = cur.fetchone()
-    conn.close()
-    return dict(row) if row else None
+    return PLANS_BY_ID.get(plan_id)
+
+def _expiry_timestamp(expires_at):
+    expiry = datetime.fromisoformat(expires_at)
+    if expiry.tzinfo is None:
+        expiry = expiry.replace(tzinfo=timezone.utc)
+    return expiry.timestamp()
 
 def apply_coupon_to_amount(code, amount):
-    if not code:
+    if not code or amount == 0:
         return amount, None
 
     conn = get_db()
     cur = conn.cursor()
-    cur.execute("SELECT * FROM coupons WHERE code=?", (code.upper(),))
-    row = cur.fetchone()
-    conn.close()
+    cur.execute("SELECT type, amount, expires_at, expires_at_ts FROM coupons WHERE code=?", (code.upper(),))
+    coupon = cur.fetchone()
 
-    if not row:
+    if not coupon:
         return amount, "INVALID"
 
-    coupon = dict(row)
+    expires_ts = coupon["expires_at_ts"]
+    if expires_ts is None and coupon["expires_at"]:
+        # SQLite could not read this value (e.g. '20250101'); parse it here
+        expires_ts = _expiry_timestamp(coupon["expires_at"])
 
-    if coupon["expires_at"]:
-        expiry = datetime.fromisoformat(coupon["expires_at"])
-        if datetime.utcnow() > expiry:
-            return amount, "EXPIRED"
+    if expires_ts is not None and time.time() > expires_ts:
+        return amount, "EXPIRED"
 
     if coupon["type"] == "flat":
         new_amount = max(0, amount - coupon["amount"])
     else:
-        new_amount = max(0, int(amount * (100 - coupon["amount"]) / 100))
+        # Coupons are written outside the app and may hold a REAL percentage
+        pct = int(coupon["amount"])
+        new_amount = max(0, amount * (100 - pct) // 100)
 
     return new_amount, None
 
@@ -244,7 +325,25 @@ def create_checkout_session(plan_id):
     coupon = session.get("coupon_code")
     final_amount, error = apply_coupon_to_amount(coupon, amount)
 
+    # One purchase attempt per plan + coupon + amount: double clicks and
+    # retries reuse its Checkout Session while it is still open, and a new
+    # attempt (and idempotency key) starts once it is paid or expired
+    params = f"{p['id']}|{coupon or ''}|{final_amount}"
+
     try:
+        attempt = session.get("checkout_attempt")
+        if attempt and attempt["params"] == params and attempt.get("session_id"):
+            previous = stripe.checkout.Session.retrieve(attempt["session_id"])
+            if previous.status == "open":
+                return redirect(previous.url, code=303)
+            attempt = None
+
+        if not attempt or attempt["params"] != params:
+            attempt = {"id": secrets.token_hex(16), "params": params}
+            session["checkout_attempt"] = attempt
+
+        idempotency_key = hashlib.sha1(f"{attempt['id']}|{params}".encode()).hexdigest()
+
         checkout = stripe.checkout.Session.create(
             payment_method_types=["card"],
             line_items=[{
@@ -256,9 +355,12 @@ def create_checkout_session(plan_id):
                 "quantity": 1
             }],
             mode="payment",
-            success_url=f"{YOUR_DOMAIN}/success?plan={p['id']}",
-            cancel_url=f"{YOUR_DOMAIN}/plan/{p['id']}"
+            metadata={"plan_id": p["id"], "plan_name": p["name"], "amount": final_amount},
+            success_url=f"{YOUR_DOMAIN}/success?session_id={{CHECKOUT_SESSION_ID}}",
+            cancel_url=f"{YOUR_DOMAIN}/plan/{p['id']}",
+            idempotency_key=idempotency_key
         )
+        session["checkout_attempt"] = dict(attempt, session_id=checkout.id)
         return redirect(checkout.url, code=303)
 
     except Exception as e:
@@ -266,7 +368,26 @@ def create_checkout_session(plan_id):
 
 @app.route("/success")
 def success():
-    return render_template("success.html")
+    # Read what was actually paid from Stripe rather than trusting the URL.
+    # This is a blocking Stripe call, so only make it for Checkout Session ids
+    plan = None
+    session_id = request.args.get("session_id", "")
+    if session_id.startswith("cs_"):
+        try:
+            checkout = stripe.checkout.Session.retrieve(session_id)
+            if checkout.payment_status == "paid":
+                # Purchase finished; the next one starts a new attempt
+                session.pop("checkout_attempt", None)
+                meta = checkout.metadata
+                plan = {
+                    "id": int(meta["plan_id"]),
+                    "name": meta["plan_name"],
+                    "price": int(meta["amount"])
+                }
+        except (stripe.error.StripeError, KeyError, ValueError, TypeError):
+            plan = None
+
+    return render_template("success.html", plan=plan)
 
 # =====================================================
 # ADMIN SYSTEM
@@ -279,11 +400,11 @@ def admin_login():
 
         conn = get_db()
         cur = conn.cursor()
-        cur.execute("SELECT * FROM admin WHERE username=? AND password=?", (user, pw))
+        cur.execute("SELECT 1 FROM admin WHERE username=? AND password=?", (user, pw))
         row = cur.fetchone()
-        conn.close()
 
         if row:
+            regenerate_session()
             session["is_admin"] = True
             return redirect(url_for("admin_dashboard"))
         else: